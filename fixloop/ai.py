@@ -1,24 +1,92 @@
 ﻿from __future__ import annotations
 
+import json
 import os
+import re
+import threading
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
-from openai import OpenAI
+if TYPE_CHECKING:
+    # openai/httpx are imported lazily; they cost hundreds of ms at startup
+    import httpx
+    from openai import OpenAI
 
 
-def load_fixloop_config() -> Dict[str, str]:
-    cfg_path = Path.home() / ".fixloop" / "config.yaml"
-    cfg: Dict[str, str] = {}
+# Parsed config.yaml keyed by (path, st_mtime_ns); editing the file invalidates it.
+_CFG_CACHE: Dict[Tuple[str, int], Dict[str, str]] = {}
+
+# Last-known-good config served without touching disk (stale-while-revalidate);
+# a daemon thread re-reads it at most every _CFG_REFRESH_INTERVAL seconds.
+_CFG_CACHED: Optional[Dict[str, str]] = None
+_CFG_REFRESH_TS = 0.0
+_CFG_REFRESH_INTERVAL = 5.0
+
+# One long-lived client per process; rebuilt only if the API key changes.
+_CLIENT: OpenAI | None = None
+_CLIENT_KEY: str = ""
+_CLIENT_LOCK = threading.Lock()
+
+
+def _read_config_file(cfg_path: Path) -> Dict[str, str]:
+    try:
+        st = os.stat(cfg_path)
+    except FileNotFoundError:
+        return {}
 
-    if cfg_path.exists():
-        for raw in cfg_path.read_text(encoding="utf-8").splitlines():
+    key = (str(cfg_path), st.st_mtime_ns)
+    cached = _CFG_CACHE.get(key)
+    if cached is not None:
+        return cached.copy()
+
+    try:
+        f = cfg_path.open("r", encoding="utf-8")
+    except FileNotFoundError:
+        return {}
+
+    cfg: Dict[str, str] = {}
+    with f:
+        for raw in f:
             line = raw.strip()
             if not line or line.startswith("#") or ":" not in line:
                 continue
             k, v = line.split(":", 1)
             cfg[k.strip()] = v.strip().strip('"').strip("'")
 
+    _CFG_CACHE.clear()
+    _CFG_CACHE[key] = cfg
+    return cfg.copy()
+
+
+def _refresh_config() -> None:
+    global _CFG_CACHED
+    # plain assignment, so readers see either the old or the new dict
+    _CFG_CACHED = _read_config_file(Path.home() / ".fixloop" / "config.yaml")
+
+
+def _revalidate_config() -> None:
+    # Background refresh: an unreadable or undecodable config (OSError,
+    # UnicodeDecodeError) keeps the last good snapshot instead of dying noisily.
+    try:
+        _refresh_config()
+    except (OSError, ValueError):
+        pass
+
+
+def load_fixloop_config() -> Dict[str, str]:
+    global _CFG_REFRESH_TS
+
+    if _CFG_CACHED is None:
+        _refresh_config()
+        _CFG_REFRESH_TS = time.monotonic()
+    elif time.monotonic() - _CFG_REFRESH_TS > _CFG_REFRESH_INTERVAL:
+        _CFG_REFRESH_TS = time.monotonic()
+        threading.Thread(target=_revalidate_config, daemon=True).start()
+
+    cfg = dict(_CFG_CACHED or {})
+
     cfg.setdefault("provider", "openai")
     cfg.setdefault("model", "gpt-4o-mini")
 
@@ -38,7 +106,42 @@ def _client_and_model() -> tuple[OpenAI, str]:
             "OpenAI API key not found. Set OPENAI_API_KEY or put openai_api_key in ~/.fixloop/config.yaml"
         )
 
-    return OpenAI(api_key=api_key), model
+    return _get_client(api_key), model
+
+
+def _http_client() -> httpx.Client:
+    import httpx
+
+    # HTTP/2 needs the optional `h2` package (pip install "httpx[http2]").
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
+
+def _get_client(api_key: str) -> OpenAI:
+    global _CLIENT, _CLIENT_KEY
+
+    client = _CLIENT
+    if client is not None and _CLIENT_KEY == api_key:
+        return client
+
+    with _CLIENT_LOCK:
+        if _CLIENT is None or _CLIENT_KEY != api_key:
+            from openai import OpenAI
+
+            if _CLIENT is not None:
+                _CLIENT.close()
+            _CLIENT = OpenAI(api_key=api_key, http_client=_http_client())
+            _CLIENT_KEY = api_key
+        return _CLIENT
 
 
 def ai_test(prompt: str) -> str:
@@ -47,57 +150,270 @@ def ai_test(prompt: str) -> str:
     return resp.output_text
 
 
-def propose_fix_for_file(
-    file_path: str,
-    file_content: str,
-    command: str,
-    stderr: str,
-    memory_hints: Optional[str] = None,
-) -> str:
+# Prompt slicing: files longer than header + 2*ctx lines are sent as a window
+# around the failing line, and only that window is asked back from the model
+# (the header is read-only context, so module-scope errors get the full file).
+_SLICE_HEADER_LINES = 20
+_SLICE_CTX = 80
+
+# Errors usually fixed at module top (a missing import/name): always send the full file
+_MODULE_SCOPE_ERR_RE = re.compile(r"^(?:NameError|ImportError|ModuleNotFoundError)\b", re.M)
+
+
+@dataclass
+class FixRequest:
+    file_path: str
+    file_content: str
+    command: str
+    stderr: str
+    memory_hints: Optional[str] = None
+    target_line: Optional[int] = None
+    stderr_truncated: bool = False
+
+
+def _slice_stderr(stderr: str, max_chars: int = 2000) -> str:
+    if len(stderr) <= max_chars:
+        return stderr
+    half = max_chars // 2
+    return stderr[:half] + "\n...\n" + stderr[-half:]
+
+
+def _slice_file(content: str, target_line: Optional[int], ctx: int = _SLICE_CTX) -> Optional[Tuple[int, int]]:
     """
-    Ask the model to return ONLY the corrected full file content (no markdown).
-    We compute diff locally and ask user approval.
+    Returns the (start, end) 0-based line range to send as the editable region,
+    or None when the whole file should be sent.
     """
+    if not target_line:
+        return None
+    n = len(content.splitlines())
+    if n <= _SLICE_HEADER_LINES + 2 * ctx or target_line > n:
+        return None
+    return max(target_line - 1 - ctx, 0), min(target_line - 1 + ctx, n)
+
+
+def _fix_window(req: FixRequest) -> Optional[Tuple[int, int]]:
+    if _MODULE_SCOPE_ERR_RE.search(req.stderr):
+        return None
+    return _slice_file(req.file_content, req.target_line)
 
-    client, model = _client_and_model()
+
+def _fix_input(req: FixRequest) -> List[Dict[str, str]]:
+    window = _fix_window(req)
+    what = "the corrected editable region" if window else "the corrected full file content"
 
     system = (
         "You are FixLoop, a careful debugging assistant.\n"
-        "Return ONLY the corrected full file content. No markdown, no code fences, no explanations.\n"
+        f"Return ONLY {what}. No markdown, no code fences, no explanations.\n"
         "Keep changes minimal. Do not rewrite unrelated parts.\n"
         "Prefer small diffs and surgical fixes.\n"
     )
 
     hints_block = ""
-    if memory_hints:
+    if req.memory_hints:
         hints_block = (
             "\n\nLocal memory (previous similar fixes):\n"
-            f"{memory_hints}\n"
+            f"{req.memory_hints}\n"
             "Use these hints ONLY if relevant. Keep changes minimal.\n"
         )
 
+    if window:
+        lines = req.file_content.splitlines()
+        start, end = window
+        n_header = min(_SLICE_HEADER_LINES, start)
+        header_block = ""
+        if n_header:
+            header = "\n".join(lines[:n_header])
+            header_block = f"File header (lines 1-{n_header}, read-only context):\n{header}\n...\n\n"
+        content_block = (
+            header_block
+            + f"Editable region (lines {start + 1}-{end} of {len(lines)}):\n"
+            + "\n".join(lines[start:end])
+            + "\n"
+        )
+        task = f"Return ONLY the corrected editable region (lines {start + 1}-{end}), nothing else.\n"
+    else:
+        content_block = f"Current file content:\n{req.file_content}\n"
+        task = "Return ONLY the full corrected file content.\n"
+
     user = (
-        f"Command:\n{command}\n\n"
-        f"Error (stderr):\n{stderr}\n\n"
-        f"Target file path:\n{file_path}\n\n"
-        f"Current file content:\n{file_content}\n"
+        f"Command:\n{req.command}\n\n"
+        f"Error (stderr{', truncated' if req.stderr_truncated else ''}):\n{_slice_stderr(req.stderr)}\n\n"
+        f"Target file path:\n{req.file_path}\n\n"
+        f"{content_block}"
         f"{hints_block}\n"
         "Task: Fix the runtime error with the smallest reasonable change.\n"
-        "Return ONLY the full corrected file content.\n"
+        f"{task}"
     )
 
-    resp = client.responses.create(
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+
+
+def _max_output_tokens(req: FixRequest) -> int:
+    window = _fix_window(req)
+    if window:
+        sent = sum(len(ln) + 1 for ln in req.file_content.splitlines()[window[0] : window[1]])
+    else:
+        sent = len(req.file_content)
+    return min(sent // 3 + 512, 8192)
+
+
+def _merge_output(req: FixRequest, out: str) -> str:
+    # Splice a returned editable region back into the full file content;
+    # an empty reply leaves the file unchanged rather than emptying it.
+    if not out:
+        return req.file_content
+    window = _fix_window(req)
+    if not window:
+        return out
+    lines = req.file_content.splitlines(keepends=True)
+    start, end = window
+
+    # A reply that echoes the read-only header would splice it into the middle
+    echo = "".join(lines[: min(3, _SLICE_HEADER_LINES, start)])
+    if echo.strip() and out.lstrip("\n").startswith(echo):
+        raise RuntimeError("Model echoed the read-only file header instead of the editable region; no fix applied.")
+    if not out.endswith("\n") and lines[end - 1].endswith("\n"):
+        out += "\n"
+    return "".join(lines[:start]) + out + "".join(lines[end:])
+
+
+def propose_fix_for_file(
+    file_path: str,
+    file_content: str,
+    command: str,
+    stderr: str,
+    memory_hints: Optional[str] = None,
+    target_line: Optional[int] = None,
+    stderr_truncated: bool = False,
+) -> str:
+    """
+    Ask the model to return ONLY the corrected full file content (no markdown).
+    We compute diff locally and ask user approval.
+    With target_line, large files are sent (and returned) as a window around it.
+    """
+
+    client, model = _client_and_model()
+    req = FixRequest(file_path, file_content, command, stderr, memory_hints, target_line, stderr_truncated)
+
+    parts: List[str] = []
+    with client.responses.stream(
         model=model,
-        input=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
+        input=_fix_input(req),
+        max_output_tokens=_max_output_tokens(req),
+    ) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+        final = stream.get_final_response()
+
+    # a cut-off (max_output_tokens) or failed reply is not a corrected file
+    if final.status != "completed":
+        details = getattr(final, "incomplete_details", None)
+        reason = getattr(details, "reason", None) if details else None
+        raise RuntimeError(f"Model response {final.status}" + (f" ({reason})" if reason else "") + "; no fix applied.")
+
+    out = _strip_fences("".join(parts).replace("\r\n", "\n"))
+    if not out.strip():
+        raise RuntimeError("Model returned an empty fix; no fix applied.")
+
+    return _merge_output(req, out)
+
+
+def propose_fixes_batch(
+    items: List[FixRequest],
+    max_wait: float = 24 * 3600,
+    on_status: Optional[Callable[[str], None]] = None,
+) -> List[str]:
+    """
+    Submit several fix requests as one OpenAI Batch job (non-interactive runs only).
+    Returns the corrected file contents in the order of `items`; "" for failed items.
+    The batch is cancelled if it outlives max_wait seconds or on KeyboardInterrupt;
+    on_status receives a progress line after every poll.
+    """
+
+    if not items:
+        return []
+
+    client, model = _client_and_model()
+
+    lines = []
+    for i, req in enumerate(items):
+        body = {"model": model, "input": _fix_input(req), "max_output_tokens": _max_output_tokens(req)}
+        lines.append(json.dumps({"custom_id": f"fix-{i}", "method": "POST", "url": "/v1/responses", "body": body}))
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+
+    batch_file = client.files.create(file=("fixloop_batch.jsonl", payload), purpose="batch")
+    batch = client.batches.create(
+        endpoint="/v1/responses",
+        input_file_id=batch_file.id,
+        completion_window="24h",
     )
 
-    out = (resp.output_text or "").replace("\r\n", "\n")
+    # poll with exponential backoff (2s, 4s, ... capped at 60s)
+    delay = 2.0
+    started = time.monotonic()
+    try:
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if time.monotonic() - started > max_wait:
+                client.batches.cancel(batch.id)
+                raise RuntimeError(f"OpenAI batch {batch.id} did not finish within {max_wait:.0f}s.")
+            time.sleep(min(delay, max(max_wait - (time.monotonic() - started), 0.0)))
+            delay = min(delay * 2, 60.0)
+            batch = client.batches.retrieve(batch.id)
+            if on_status:
+                counts = batch.request_counts
+                done = f", {counts.completed}/{counts.total} done" if counts else ""
+                on_status(f"batch {batch.id}: {batch.status}{done} ({time.monotonic() - started:.0f}s)")
+    except KeyboardInterrupt:
+        try:
+            client.batches.cancel(batch.id)
+        except Exception:
+            pass
+        raise
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"OpenAI batch {batch.id} ended with status: {batch.status}")
+
+    outputs: Dict[str, str] = {}
+    for raw in client.files.content(batch.output_file_id).text.splitlines():
+        if not raw.strip():
+            continue
+        row = json.loads(raw)
+        resp = row.get("response") or {}
+        body = resp.get("body") or {}
+        if resp.get("status_code") != 200 or body.get("status") != "completed":
+            continue
+        out = _strip_fences(_response_text(body).replace("\r\n", "\n"))
+        if out.strip():
+            outputs[row["custom_id"]] = out
+
+    merged: List[str] = []
+    for i, req in enumerate(items):
+        try:
+            merged.append(_merge_output(req, outputs[f"fix-{i}"]) if f"fix-{i}" in outputs else "")
+        except RuntimeError:
+            merged.append("")
+    return merged
+
+
+def _response_text(body: Dict) -> str:
+    # Raw Responses API JSON has no `output_text` shortcut; collect it from message items.
+    parts: List[str] = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for c in item.get("content") or []:
+            if c.get("type") == "output_text":
+                parts.append(c.get("text") or "")
+    return "".join(parts)
 
-    # Safety: strip accidental fences
-    if "```" in out:
-        out = out.replace("```python", "").replace("```", "").strip()
 
-    return out
+def _strip_fences(out: str) -> str:
+    # Safety: drop accidental fence lines (```python / ```) in a single pass.
+    # No .strip(): a returned region may start with indented code.
+    if "```" not in out:
+        return out
+    return "\n".join(ln for ln in out.split("\n") if not ln.lstrip().startswith("```"))
@@ -1,6 +1,7 @@
 ﻿import argparse
 import os
 from pathlib import Path
+from typing import List, Optional
 
 from . import __version__
 
@@ -26,7 +27,7 @@ def _write_default_config(openai_key: str = "") -> None:
     _config_path().write_text(content, encoding="utf-8")
 
 
-def main():
+def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         prog="fixloop",
         description="FixLoop — Your Personal Code Guard",
@@ -40,6 +41,11 @@ def main():
     fix_cmd.add_argument("--verify", help="Verification command (optional)")
     fix_cmd.add_argument("--yes", action="store_true", help="Auto-apply patch without prompting")
     fix_cmd.add_argument("--max-iters", type=int, default=1, help="Max fix attempts (default: 1)")
+    fix_cmd.add_argument(
+        "--batch",
+        action="store_true",
+        help="Request all attempts' candidate fixes up front via the OpenAI Batch API (slower, cheaper)",
+    )
 
     # init command
     subparsers.add_parser("init", help="Initialize FixLoop configuration")
@@ -51,7 +57,17 @@ def main():
     ai_cmd = subparsers.add_parser("ai-test", help="Test OpenAI connection (BYOK)")
     ai_cmd.add_argument("--prompt", default="Return only the word OK.", help="Prompt to send")
 
-    args = parser.parse_args()
+    return parser
+
+
+_PARSER = _build_parser()
+
+
+def dispatch(argv: Optional[List[str]] = None) -> int:
+    """
+    Run one FixLoop command in-process; argv defaults to sys.argv[1:].
+    """
+    args = _PARSER.parse_args(argv)
 
     if args.command == "init":
         key = os.getenv("OPENAI_API_KEY", "").strip()
@@ -80,6 +96,7 @@ def main():
             verify_cmd=args.verify,
             yes=args.yes,
             max_iters=args.max_iters,
+            batch=args.batch,
         )
         print(outcome.message)
         return 0 if outcome.ok else 1
@@ -88,9 +105,13 @@ def main():
         print(__version__)
         return 0
 
-    parser.print_help()
+    _PARSER.print_help()
     return 0
 
 
+def main():
+    return dispatch()
+
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,20 @@
 ﻿from __future__ import annotations
 
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
-from .runner import run_command
-from .ai import propose_fix_for_file
-from .memory import search_similar, save_fix
+from .runner import RunResult, run_command
+from .ai import FixRequest, propose_fix_for_file, propose_fixes_batch
+from .memory import MemoryHit, fix_record, save_fixes, search_similar
+
+
+_PY_FRAME_RE = re.compile(r'File "([^"]+\.py)", line (\d+)')
+
+# One long-lived worker for file reads that overlap the memory lookup
+_FILE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fixloop-read")
 
 
 @dataclass
@@ -16,15 +23,33 @@ class FixOutcome:
     message: str
 
 
-def _extract_primary_py_file(stderr: str) -> Optional[str]:
-    matches = re.findall(r'File "([^"]+\.py)"', stderr)
+def _extract_primary_frame(stderr: str) -> Optional[Tuple[str, int]]:
+    matches = _PY_FRAME_RE.findall(stderr)
     if not matches:
         return None
-    return matches[-1]
+    path, line = matches[-1]
+    return path, int(line)
 
 
-def _unified_diff(old: str, new: str, path: str) -> str:
+def _difflib():
     import difflib
+
+    # Optional C SequenceMatcher (pip install "fixloop[speedups]"); unified_diff
+    # looks SequenceMatcher up in the difflib module, so swap it there.
+    try:
+        from cdifflib import CSequenceMatcher
+    except ImportError:
+        pass
+    else:
+        difflib.SequenceMatcher = CSequenceMatcher
+    return difflib
+
+
+def _unified_diff(old: str, new: str, path: str) -> Tuple[str, int]:
+    """
+    Returns (diff_text, changed_lines); lines are counted while the diff is generated.
+    """
+    difflib = _difflib()
     old_lines = old.splitlines(keepends=True)
     new_lines = new.splitlines(keepends=True)
     diff = difflib.unified_diff(
@@ -33,21 +58,19 @@ def _unified_diff(old: str, new: str, path: str) -> str:
         fromfile=f"a/{path}",
         tofile=f"b/{path}",
     )
-    return "".join(diff)
 
-
-def _count_changed_lines(diff_text: str) -> int:
-    n = 0
-    for line in diff_text.splitlines():
+    parts: List[str] = []
+    changed = 0
+    for line in diff:
+        parts.append(line)
         if line.startswith(("+++ ", "--- ", "@@")):
             continue
-        if line.startswith("+") or line.startswith("-"):
-            n += 1
-    return n
+        if line[:1] in ("+", "-"):
+            changed += 1
+    return "".join(parts), changed
 
 
-def _gate_large_diff(diff_text: str, max_changed_lines: int) -> Tuple[bool, str]:
-    changed = _count_changed_lines(diff_text)
+def _gate_large_diff(changed: int, max_changed_lines: int) -> Tuple[bool, str]:
     if changed > max_changed_lines:
         return False, f"❌ Safety gate: diff too large ({changed} changed lines > {max_changed_lines})."
     return True, ""
@@ -61,8 +84,7 @@ def _ask_approval(diff_text: str) -> bool:
     return ans in ("y", "yes")
 
 
-def _format_memory_hints(stderr: str, limit: int = 3) -> str:
-    hits = search_similar(stderr, limit=limit)
+def _format_hits(hits: List[MemoryHit]) -> str:
     if not hits:
         return ""
 
@@ -77,12 +99,52 @@ def _format_memory_hints(stderr: str, limit: int = 3) -> str:
     return "\n".join(blocks)
 
 
+def _locate_target_file(result: RunResult) -> Union[FixOutcome, Tuple[Path, int]]:
+    """
+    Locate the failing .py file from the traceback; returns (path, line)
+    or a FixOutcome describing why it cannot be fixed.
+    """
+    frame = _extract_primary_frame(result.stderr) or _extract_primary_frame(result.stdout)
+    if not frame:
+        return FixOutcome(False, f"❌ Command failed, but no .py file found in traceback.\n\nSTDERR:\n{result.stderr}")
+    target_file, target_line = frame
+
+    p = Path(target_file)
+    if not p.is_absolute():
+        p = (Path.cwd() / p).resolve()
+
+    if not p.exists():
+        return FixOutcome(False, f"❌ File not found: {p}")
+
+    return p, target_line
+
+
+# How long a --batch run waits for batched candidates before going synchronous
+_BATCH_MAX_WAIT = 10 * 60.0
+
+
+def _batch_candidates(req: FixRequest, n: int) -> List[str]:
+    print(f"[FixLoop] Requesting {n} candidate fixes via OpenAI Batch (up to {_BATCH_MAX_WAIT / 60:.0f} min)...")
+    try:
+        outs = propose_fixes_batch(
+            [req] * n,
+            max_wait=_BATCH_MAX_WAIT,
+            on_status=lambda msg: print(f"[FixLoop] {msg}"),
+        )
+    except Exception as e:
+        # batch failures fall back to the synchronous path
+        print(f"[FixLoop] Batch failed ({e}); falling back to synchronous fixes.")
+        return []
+    return [out for out in outs if out]
+
+
 def fix_loop(
     cmd: str,
     verify_cmd: Optional[str] = None,
     yes: bool = False,
     max_iters: int = 1,
     max_changed_lines: int = 60,
+    batch: bool = False,
 ) -> FixOutcome:
     """
     FixLoop:
@@ -94,8 +156,17 @@ def fix_loop(
       - Apply (approval)
       - Re-run + verify
       - On success: save fix to local memory (SQLite)
+
+    With batch=True (opt-in, `fix --batch`), candidate fixes for the first
+    failing file are requested up front in one OpenAI Batch job; they are all
+    samples of that first state, not iterative refinements.
     """
 
+    # Batched candidates are all fixes of the first failing state (batch_req);
+    # each one is diffed against and recorded with that state, not the current file.
+    batch_req: Optional[FixRequest] = None
+    candidates: List[str] = []
+
     for attempt in range(1, max_iters + 1):
         result = run_command(cmd)
 
@@ -109,34 +180,52 @@ def fix_loop(
             return FixOutcome(True, "✅ Command succeeded.")
 
         # failure
-        target_file = _extract_primary_py_file(result.stderr) or _extract_primary_py_file(result.stdout)
-        if not target_file:
-            return FixOutcome(False, f"❌ Command failed, but no .py file found in traceback.\n\nSTDERR:\n{result.stderr}")
-
-        p = Path(target_file)
-        if not p.is_absolute():
-            p = (Path.cwd() / p).resolve()
-
-        if not p.exists():
-            return FixOutcome(False, f"❌ File not found: {p}")
-
-        old_content = p.read_text(encoding="utf-8")
-
-        # MEMORY SEARCH (before AI)
-        memory_hints = _format_memory_hints(result.stderr, limit=3)
-
-        new_content = propose_fix_for_file(
-            file_path=str(p),
-            file_content=old_content,
-            command=cmd,
-            stderr=result.stderr,
-            memory_hints=memory_hints if memory_hints else None,
-        )
-
-        diff_text = _unified_diff(old_content, new_content, str(p).replace("\\", "/"))
+        target = _locate_target_file(result)
+        if isinstance(target, FixOutcome):
+            return target
+        p, target_line = target
+
+        # MEMORY SEARCH (before AI) runs here while the worker reads the target
+        # file; SQLite stays on this thread's cached connection
+        file_fut = _FILE_POOL.submit(p.read_text, encoding="utf-8")
+        memory_hints = _format_hits(search_similar(result.stderr, limit=3))
+        old_content = file_fut.result()
+
+        if batch and batch_req is None:
+            batch_req = FixRequest(
+                file_path=str(p),
+                file_content=old_content,
+                command=cmd,
+                stderr=result.stderr,
+                memory_hints=memory_hints if memory_hints else None,
+                target_line=target_line,
+                stderr_truncated=result.stderr_truncated,
+            )
+            candidates = _batch_candidates(batch_req, n=max_iters - attempt + 1)
+
+        fix_stderr = result.stderr
+        if candidates and batch_req is not None and batch_req.file_path == str(p):
+            new_content = candidates.pop(0)
+            old_content, fix_stderr = batch_req.file_content, batch_req.stderr
+        else:
+            try:
+                new_content = propose_fix_for_file(
+                    file_path=str(p),
+                    file_content=old_content,
+                    command=cmd,
+                    stderr=result.stderr,
+                    memory_hints=memory_hints if memory_hints else None,
+                    target_line=target_line,
+                    stderr_truncated=result.stderr_truncated,
+                )
+            except RuntimeError as e:
+                # incomplete/empty replies: leave the file untouched
+                return FixOutcome(False, f"❌ AI fix failed: {e}")
+
+        diff_text, changed = _unified_diff(old_content, new_content, str(p).replace("\\", "/"))
 
         # SAFETY GATE
-        ok_gate, gate_msg = _gate_large_diff(diff_text, max_changed_lines=max_changed_lines)
+        ok_gate, gate_msg = _gate_large_diff(changed, max_changed_lines=max_changed_lines)
         if not ok_gate:
             print("\n--- Proposed diff (diff-only) ---")
             print(diff_text if diff_text.strip() else "(no changes)")
@@ -163,7 +252,9 @@ def fix_loop(
 
             # SAVE TO MEMORY (only on success)
             try:
-                save_fix(cmd=cmd, file_path=str(p), stderr=result.stderr, diff=diff_text, new_file_content=new_content)
+                rec = fix_record(cmd=cmd, file_path=str(p), stderr=fix_stderr, diff=diff_text, new_file_content=new_content)
+                if rec is not None:
+                    save_fixes([rec])
             except Exception:
                 # memory failures should never break the main tool
                 pass
@@ -1,11 +1,13 @@
 ﻿from __future__ import annotations
 
+import atexit
 import hashlib
 import sqlite3
+import threading
 import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
 
 DB_DIR = Path.home() / ".fixloop"
@@ -21,15 +23,58 @@ class MemoryHit:
     diff_excerpt: str
 
 
-def _sha256(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
-
-
-def _ensure_db() -> sqlite3.Connection:
-    DB_DIR.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(str(DB_PATH))
-    conn.row_factory = sqlite3.Row
-
+def _sha256(text: str) -> bytes:
+    # raw 32-byte digest: half the size of hex in rows and in idx_fixes_stderr_hash
+    return hashlib.sha256(text.encode("utf-8", errors="ignore")).digest()
+
+
+def _needle(stderr: str) -> str:
+    # Error signature: last non-empty line (e.g. "TypeError: ..."), capped
+    lines = [ln.strip() for ln in stderr.splitlines() if ln.strip()]
+    needle = lines[-1] if lines else stderr
+    return needle[:120]
+
+
+# Hot-path SQL kept as constants; the connection's statement cache reuses
+# the prepared statements across calls.
+_INSERT_SQL = """
+    INSERT INTO fixes(created_at, cmd, file_path, stderr, stderr_hash, diff, new_file_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
+_SEARCH_SQL = """
+    SELECT f.id, f.created_at,
+           bm25(fixes_fts) AS score,
+           substr(f.stderr, 1, 600) AS stderr_excerpt,
+           substr(f.diff, 1, 600) AS diff_excerpt
+    FROM fixes_fts
+    JOIN fixes f ON f.id = fixes_fts.rowid
+    WHERE fixes_fts MATCH ?
+    ORDER BY score ASC
+    LIMIT ?;
+"""
+
+_FALLBACK_SQL = """
+    SELECT id, created_at, stderr, diff
+    FROM fixes
+    WHERE stderr_hash = ?
+    ORDER BY id DESC
+    LIMIT ?;
+"""
+
+# PRAGMA user_version of the current schema
+_SCHEMA_VERSION = 2
+
+_LOCAL = threading.local()
+_SCHEMA_LOCK = threading.Lock()
+_SCHEMA_DONE = False
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    # IMMEDIATE: take the write lock up front. _migrate reads user_version and then
+    # writes, and a deferred read->write upgrade fails with SQLITE_BUSY right away
+    # (no busy timeout) when another process is migrating the same database.
+    conn.execute("BEGIN IMMEDIATE;")
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS fixes (
@@ -38,26 +83,35 @@ def _ensure_db() -> sqlite3.Connection:
             cmd TEXT NOT NULL,
             file_path TEXT NOT NULL,
             stderr TEXT NOT NULL,
-            stderr_hash TEXT NOT NULL,
+            stderr_hash BLOB NOT NULL,
             diff TEXT NOT NULL,
-            new_file_hash TEXT NOT NULL
+            new_file_hash BLOB NOT NULL
         );
         """
     )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fixes_stderr_hash ON fixes(stderr_hash);")
+    old_version = _migrate(conn)
 
-    # Try create FTS5 index (optional)
+    # Try create FTS5 index (optional); trigram needs SQLite 3.34+
     try:
-        conn.execute(
-            """
-            CREATE VIRTUAL TABLE IF NOT EXISTS fixes_fts
-            USING fts5(
-                stderr,
-                diff,
-                content='fixes',
-                content_rowid='id'
-            );
-            """
-        )
+        for tokenize in ("trigram", "unicode61"):
+            try:
+                conn.execute(
+                    f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS fixes_fts
+                    USING fts5(
+                        stderr,
+                        diff,
+                        content='fixes',
+                        content_rowid='id',
+                        tokenize='{tokenize}'
+                    );
+                    """
+                )
+                break
+            except sqlite3.OperationalError:
+                if tokenize == "unicode61":
+                    raise
         conn.execute(
             """
             CREATE TRIGGER IF NOT EXISTS fixes_ai AFTER INSERT ON fixes BEGIN
@@ -80,83 +134,133 @@ def _ensure_db() -> sqlite3.Connection:
             END;
             """
         )
-        conn.commit()
+        if old_version < 2:
+            # index rows that existed before the table was (re)created
+            conn.execute("INSERT INTO fixes_fts(fixes_fts) VALUES('rebuild');")
     except sqlite3.OperationalError:
         # FTS5 not available - OK
         pass
 
-    return conn
+    conn.execute("COMMIT;")
 
 
-def _fts_available(conn: sqlite3.Connection) -> bool:
-    try:
-        conn.execute("SELECT 1 FROM fixes_fts LIMIT 1;")
-        return True
-    except sqlite3.OperationalError:
-        return False
+def _migrate(conn: sqlite3.Connection) -> int:
+    """
+    Upgrade an existing database in place; returns the version it started at.
+    """
+    version = int(conn.execute("PRAGMA user_version;").fetchone()[0])
+
+    if version < 1:
+        # v1: hashes stored as raw digests (BLOB) instead of hex text, and
+        # stderr_hash is the error-signature hash (_needle), recomputed from stderr
+        rows = conn.execute(
+            "SELECT id, stderr, new_file_hash FROM fixes WHERE typeof(new_file_hash) = 'text';"
+        ).fetchall()
+        conn.executemany(
+            "UPDATE fixes SET stderr_hash = ?, new_file_hash = ? WHERE id = ?;",
+            [(_sha256(_needle(r["stderr"])), bytes.fromhex(r["new_file_hash"]), r["id"]) for r in rows],
+        )
 
+    if version < 2:
+        # v2: fixes_fts uses the trigram tokenizer; drop it so _create_schema rebuilds it
+        try:
+            for trigger in ("fixes_ai", "fixes_ad", "fixes_au"):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+            conn.execute("DROP TABLE IF EXISTS fixes_fts;")
+        except sqlite3.OperationalError:
+            # FTS5 not available - OK
+            pass
 
-def _fts_query(stderr: str) -> str:
+    if version < _SCHEMA_VERSION:
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION};")
+
+    return version
+
+
+def _ensure_db() -> sqlite3.Connection:
     """
-    Build a safe FTS query for Windows:
-    - drop drive-letter paths (C:\\...)
-    - drop tokens containing slashes/backslashes
-    - keep only [A-Za-z0-9_]
-    - quote tokens to avoid FTS syntax issues
+    Return this thread's cached connection. The schema is created once per
+    process; connections stay open until interpreter exit.
     """
-    import re
+    global _SCHEMA_DONE
 
-    raw_tokens = stderr.replace("\r", "\n").split()
-    tokens: List[str] = []
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is not None:
+        return conn
 
-    for raw in raw_tokens:
-        t = raw.strip()
+    DB_DIR.mkdir(parents=True, exist_ok=True)
+    # check_same_thread=False only so atexit can close it; each thread still uses its own.
+    # isolation_level=None: autocommit, transactions are opened explicitly with BEGIN.
+    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False, cached_statements=256, isolation_level=None)
+    conn.row_factory = sqlite3.Row
 
-        # Drop obvious Windows paths / drive letters
-        if re.match(r"^[A-Za-z]:\\", t) or "\\" in t or "/" in t:
-            continue
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=134217728;")
 
-        # Keep only word-like parts
-        t2 = re.sub(r"[^A-Za-z0-9_]", "", t)
-        if len(t2) < 4:
-            continue
+    with _SCHEMA_LOCK:
+        if not _SCHEMA_DONE:
+            _create_schema(conn)
+            _SCHEMA_DONE = True
+
+    _LOCAL.conn = conn
+    atexit.register(conn.close)
+    return conn
 
-        low = t2.lower()
-        if low in {"traceback", "error", "exception", "line", "file", "most", "recent", "call", "last"}:
-            continue
 
-        tokens.append(t2)
+def _fts_available(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute("SELECT 1 FROM fixes_fts LIMIT 1;")
+        return True
+    except sqlite3.OperationalError:
+        return False
 
-    if not tokens:
-        tokens = ["TypeError", "ValueError"]
 
-    tokens = tokens[:10]
-    return " OR ".join([f'"{tok}"' for tok in tokens])
+def _fts_query(stderr: str) -> str:
+    """
+    Build a trigram phrase query from the error signature (last stderr line):
+    - one quoted phrase, so no OR-union over common tokens
+    - embedded double quotes are doubled to stay valid FTS syntax
+    """
+    needle = _needle(stderr)[:80].replace('"', '""')
+    return f'"{needle}"'
 
 
-def save_fix(cmd: str, file_path: str, stderr: str, diff: str, new_file_content: str) -> None:
+def fix_record(cmd: str, file_path: str, stderr: str, diff: str, new_file_content: str) -> Optional[Tuple]:
+    """
+    Build one `fixes` row for save_fixes(); None if there is nothing worth saving.
+    """
     created_at = time.strftime("%Y-%m-%d %H:%M:%S")
     stderr = (stderr or "").strip()
     diff = (diff or "").strip()
 
     if not stderr or not diff:
-        return
+        return None
 
-    stderr_hash = _sha256(stderr[:4000])
+    stderr_hash = _sha256(_needle(stderr))
     new_hash = _sha256(new_file_content[:8000])
 
+    return (created_at, cmd, file_path, stderr[:20000], stderr_hash, diff[:20000], new_hash)
+
+
+def save_fixes(records: List[Tuple]) -> None:
+    """
+    Insert many fix_record() rows in a single transaction (one commit/fsync).
+    """
+    if not records:
+        return
+
     conn = _ensure_db()
-    try:
-        conn.execute(
-            """
-            INSERT INTO fixes(created_at, cmd, file_path, stderr, stderr_hash, diff, new_file_hash)
-            VALUES (?, ?, ?, ?, ?, ?, ?);
-            """,
-            (created_at, cmd, file_path, stderr[:20000], stderr_hash, diff[:20000], new_hash),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with conn:
+        conn.execute("BEGIN;")
+        conn.executemany(_INSERT_SQL, records)
+
+
+def save_fix(cmd: str, file_path: str, stderr: str, diff: str, new_file_content: str) -> None:
+    rec = fix_record(cmd, file_path, stderr, diff, new_file_content)
+    if rec is not None:
+        save_fixes([rec])
 
 
 def search_similar(stderr: str, limit: int = 3) -> List[MemoryHit]:
@@ -165,71 +269,40 @@ def search_similar(stderr: str, limit: int = 3) -> List[MemoryHit]:
         return []
 
     conn = _ensure_db()
-    try:
-        hits: List[MemoryHit] = []
-
-        if _fts_available(conn):
-            try:
-                rows = conn.execute(
-                    """
-                    SELECT f.id, f.created_at,
-                           bm25(fixes_fts) AS score,
-                           substr(f.stderr, 1, 600) AS stderr_excerpt,
-                           substr(f.diff, 1, 600) AS diff_excerpt
-                    FROM fixes_fts
-                    JOIN fixes f ON f.id = fixes_fts.rowid
-                    WHERE fixes_fts MATCH ?
-                    ORDER BY score ASC
-                    LIMIT ?;
-                    """,
-                    (_fts_query(stderr), limit),
-                ).fetchall()
-
-                for r in rows:
-                    hits.append(
-                        MemoryHit(
-                            id=int(r["id"]),
-                            created_at=str(r["created_at"]),
-                            score=float(r["score"]),
-                            stderr_excerpt=str(r["stderr_excerpt"]),
-                            diff_excerpt=str(r["diff_excerpt"]),
-                        )
+    hits: List[MemoryHit] = []
+
+    if _fts_available(conn):
+        try:
+            rows = conn.execute(_SEARCH_SQL, (_fts_query(stderr), limit)).fetchall()
+
+            for r in rows:
+                hits.append(
+                    MemoryHit(
+                        id=int(r["id"]),
+                        created_at=str(r["created_at"]),
+                        score=float(r["score"]),
+                        stderr_excerpt=str(r["stderr_excerpt"]),
+                        diff_excerpt=str(r["diff_excerpt"]),
                     )
-                return hits
-
-            except sqlite3.OperationalError:
-                # If FTS query parsing fails, fallback safely
-                pass
-
-        # Fallback: LIKE search (works everywhere)
-        # Use a small needle: last line or key phrase
-        lines = [ln.strip() for ln in stderr.splitlines() if ln.strip()]
-        needle = lines[-1] if lines else stderr
-        needle = needle[:120]
-
-        rows = conn.execute(
-            """
-            SELECT id, created_at, stderr, diff
-            FROM fixes
-            WHERE stderr LIKE ?
-            ORDER BY id DESC
-            LIMIT ?;
-            """,
-            (f"%{needle}%", limit),
-        ).fetchall()
-
-        for r in rows:
-            hits.append(
-                MemoryHit(
-                    id=int(r["id"]),
-                    created_at=str(r["created_at"]),
-                    score=0.0,
-                    stderr_excerpt=str(r["stderr"])[:600],
-                    diff_excerpt=str(r["diff"])[:600],
                 )
+            return hits
+
+        except sqlite3.OperationalError:
+            # If FTS query parsing fails, fallback safely
+            pass
+
+    # Fallback: exact error-signature match via idx_fixes_stderr_hash (works everywhere)
+    rows = conn.execute(_FALLBACK_SQL, (_sha256(_needle(stderr)), limit)).fetchall()
+
+    for r in rows:
+        hits.append(
+            MemoryHit(
+                id=int(r["id"]),
+                created_at=str(r["created_at"]),
+                score=0.0,
+                stderr_excerpt=str(r["stderr"])[:600],
+                diff_excerpt=str(r["diff"])[:600],
             )
+        )
 
-        return hits
-
-    finally:
-        conn.close()
+    return hits
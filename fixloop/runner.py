@@ -1,7 +1,14 @@
 ﻿from __future__ import annotations
 
+import locale
 import subprocess
+import threading
 from dataclasses import dataclass
+from typing import IO, List, Tuple
+
+
+# Max bytes kept per stream (head + tail halves); the rest is drained and dropped.
+MAX_CAPTURE = 131072
 
 
 @dataclass
@@ -10,17 +17,82 @@ class RunResult:
     returncode: int
     stdout: str
     stderr: str
+    stdout_truncated: bool = False
+    stderr_truncated: bool = False
+
+
+def _drain(pipe: IO[bytes], limit: int) -> Tuple[bytes, bool]:
+    """
+    Read a pipe to EOF, keeping the first and last limit//2 bytes.
+    Keeps reading past the limit so the child never blocks on a full pipe.
+    """
+    half = limit // 2
+    head = bytearray()
+    tail = bytearray()
+    truncated = False
+
+    with pipe:
+        for chunk in iter(lambda: pipe.read(65536), b""):
+            if len(head) < half:
+                take = half - len(head)
+                head += chunk[:take]
+                chunk = chunk[take:]
+            if chunk:
+                tail += chunk
+                if len(tail) > half:
+                    del tail[: len(tail) - half]
+                    truncated = True
+
+    if truncated:
+        return bytes(head) + b"\n...\n" + bytes(tail), True
+    return bytes(head + tail), False
+
+
+def _decode(data: bytes) -> str:
+    # same encoding/newline handling as subprocess text=True, but never fails
+    text = data.decode(locale.getpreferredencoding(False), errors="replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
 
 
 def run_command(cmd: str, cwd: str | None = None) -> RunResult:
     """
-    Runs a shell command and captures stdout/stderr.
+    Runs a shell command and captures stdout/stderr (each capped at MAX_CAPTURE bytes).
     """
-    p = subprocess.run(
+    out: List[Tuple[bytes, bool]] = [(b"", False), (b"", False)]
+
+    def reader(i: int, pipe: IO[bytes]) -> None:
+        out[i] = _drain(pipe, MAX_CAPTURE)
+
+    with subprocess.Popen(
         cmd,
         shell=True,
         cwd=cwd,
-        text=True,
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=-1,
+    ) as p:
+        try:
+            threads = [
+                threading.Thread(target=reader, args=(0, p.stdout), daemon=True),
+                threading.Thread(target=reader, args=(1, p.stderr), daemon=True),
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            returncode = p.wait()
+        except BaseException:
+            # like subprocess.run: never leave the child running (e.g. Ctrl-C)
+            p.kill()
+            p.wait()
+            raise
+
+    (stdout, out_trunc), (stderr, err_trunc) = out
+    return RunResult(
+        cmd=cmd,
+        returncode=returncode,
+        stdout=_decode(stdout),
+        stderr=_decode(stderr),
+        stdout_truncated=out_trunc,
+        stderr_truncated=err_trunc,
     )
-    return RunResult(cmd=cmd, returncode=p.returncode, stdout=p.stdout or "", stderr=p.stderr or "")
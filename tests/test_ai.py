@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+from fixloop import ai
+from fixloop.ai import FixRequest, _fix_input, _merge_output, _response_text, _slice_file, _strip_fences
+
+
+def _file(n: int) -> str:
+    return "".join(f"    x{i} = {i}\n" for i in range(1, n + 1))
+
+
+def _req(content: str, target_line):
+    return FixRequest("a.py", content, "python a.py", "err", None, target_line)
+
+
+def test_slice_file_small_or_unknown_line_sends_whole_file():
+    assert _slice_file(_file(100), 50) is None
+    assert _slice_file(_file(400), None) is None
+    assert _slice_file(_file(400), 401) is None
+
+
+def test_slice_file_window_is_clamped():
+    assert _slice_file(_file(400), 200) == (119, 279)
+    assert _slice_file(_file(400), 1) == (0, 80)
+    assert _slice_file(_file(400), 400) == (319, 400)
+
+
+def test_merge_output_empty_reply_keeps_file():
+    content = _file(400)
+    assert _merge_output(_req(content, 200), "") == content
+    assert _merge_output(_req(_file(10), 5), "") == _file(10)
+
+
+def test_merge_output_splices_region_and_keeps_indentation():
+    content = _file(400)
+    req = _req(content, 200)
+    lines = content.splitlines(keepends=True)
+    region = "".join(lines[119:279]).replace("x200 = 200", "x200 = 0")
+
+    reply = _strip_fences("```python\n" + region.rstrip("\n") + "\n```")
+    merged = _merge_output(req, reply)
+
+    assert merged == content.replace("x200 = 200", "x200 = 0")
+    assert merged.splitlines()[119] == "    x120 = 120"
+
+
+def test_strip_fences_keeps_leading_whitespace():
+    assert _strip_fences("```\n    y = 1\n```") == "    y = 1"
+    assert _strip_fences("    y = 1\n") == "    y = 1\n"
+
+
+def test_fix_input_omits_header_when_window_starts_at_top():
+    user = _fix_input(_req(_file(400), 1))[1]["content"]
+    assert "File header" not in user
+    assert "Editable region (lines 1-80 of 400)" in user
+
+    user = _fix_input(_req(_file(400), 200))[1]["content"]
+    assert "File header (lines 1-20, read-only context)" in user
+
+
+class _Obj:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+def _body(text, status="completed"):
+    return {
+        "status": status,
+        "output": [
+            {"type": "reasoning", "summary": []},
+            {"type": "message", "content": [{"type": "output_text", "text": text}]},
+        ],
+    }
+
+
+class _FakeClient:
+    def __init__(self, rows):
+        self.uploaded = None
+        out = "\n".join(json.dumps(r) for r in rows) + "\n"
+        self.files = _Obj(
+            create=lambda file, purpose: (setattr(self, "uploaded", file[1]), _Obj(id="in"))[1],
+            content=lambda file_id: _Obj(text=out),
+        )
+        self.batches = _Obj(
+            create=lambda **kw: _Obj(id="b1", status="completed", output_file_id="out"),
+        )
+
+
+def test_response_text_collects_message_output_only():
+    assert _response_text(_body("abc")) == "abc"
+    assert _response_text({"output": [{"type": "reasoning"}]}) == ""
+
+
+def test_propose_fixes_batch_maps_results_by_custom_id(monkeypatch):
+    rows = [
+        # out of order, one HTTP error, one incomplete (cut off) response
+        {"custom_id": "fix-2", "response": {"status_code": 200, "body": _body("c = 3\n")}},
+        {"custom_id": "fix-0", "response": {"status_code": 200, "body": _body("```python\na = 1\n```")}},
+        {"custom_id": "fix-1", "response": {"status_code": 500, "body": {}}},
+        {"custom_id": "fix-3", "response": {"status_code": 200, "body": _body("d =", status="incomplete")}},
+    ]
+    client = _FakeClient(rows)
+    monkeypatch.setattr(ai, "_client_and_model", lambda: (client, "m"))
+
+    items = [_req("x = 0\n", None) for _ in range(4)]
+    assert ai.propose_fixes_batch(items) == ["a = 1", "", "c = 3\n", ""]
+
+    sent = [json.loads(ln) for ln in client.uploaded.decode("utf-8").splitlines()]
+    assert [r["custom_id"] for r in sent] == ["fix-0", "fix-1", "fix-2", "fix-3"]
+    assert all(r["url"] == "/v1/responses" and r["body"]["model"] == "m" for r in sent)
+
+
+def test_module_scope_errors_send_full_file():
+    content = "import sys\n" + _file(399)
+    req = FixRequest("a.py", content, "python a.py", "Traceback\nNameError: name 'os' is not defined", None, 300)
+    user = _fix_input(req)[1]["content"]
+    assert "Editable region" not in user
+    assert "Current file content" in user
+    assert _merge_output(req, "import os\n" + content) == "import os\n" + content
+
+
+def test_merge_output_rejects_echoed_header():
+    content = "import sys\n" + _file(399)
+    req = _req(content, 200)
+    lines = content.splitlines(keepends=True)
+    reply = "".join(lines[:20]) + "".join(lines[119:279])
+    with pytest.raises(RuntimeError):
+        _merge_output(req, reply)
@@ -0,0 +1,115 @@
+import hashlib
+import sqlite3
+import threading
+
+import pytest
+
+from fixloop import memory
+
+
+# Schema and hashing as written by fixloop 0.1.0 (before user_version existed)
+BASELINE_SCHEMA = """
+CREATE TABLE fixes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    cmd TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    stderr TEXT NOT NULL,
+    stderr_hash TEXT NOT NULL,
+    diff TEXT NOT NULL,
+    new_file_hash TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE fixes_fts USING fts5(stderr, diff, content='fixes', content_rowid='id');
+CREATE TRIGGER fixes_ai AFTER INSERT ON fixes BEGIN
+    INSERT INTO fixes_fts(rowid, stderr, diff) VALUES (new.id, new.stderr, new.diff);
+END;
+CREATE TRIGGER fixes_ad AFTER DELETE ON fixes BEGIN
+    INSERT INTO fixes_fts(fixes_fts, rowid, stderr, diff) VALUES('delete', old.id, old.stderr, old.diff);
+END;
+CREATE TRIGGER fixes_au AFTER UPDATE ON fixes BEGIN
+    INSERT INTO fixes_fts(fixes_fts, rowid, stderr, diff) VALUES('delete', old.id, old.stderr, old.diff);
+    INSERT INTO fixes_fts(rowid, stderr, diff) VALUES (new.id, new.stderr, new.diff);
+END;
+"""
+
+STDERR = 'Traceback (most recent call last):\n  File "bug.py", line 2, in add\nTypeError: can only concatenate str (not "int") to str'
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory, "DB_DIR", tmp_path)
+    monkeypatch.setattr(memory, "DB_PATH", tmp_path / "fixloop.db")
+    monkeypatch.setattr(memory, "_LOCAL", threading.local())
+    monkeypatch.setattr(memory, "_SCHEMA_DONE", False)
+    yield tmp_path / "fixloop.db"
+    conn = getattr(memory._LOCAL, "conn", None)
+    if conn is not None:
+        conn.close()
+
+
+def _hex(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def _write_baseline_db(path) -> None:
+    conn = sqlite3.connect(str(path))
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute(
+        "INSERT INTO fixes(created_at, cmd, file_path, stderr, stderr_hash, diff, new_file_hash) VALUES (?, ?, ?, ?, ?, ?, ?);",
+        ("2025-01-01 00:00:00", "python bug.py", "bug.py", STDERR, _hex(STDERR[:4000]), "-a + b\n+int(a) + b", _hex("new")),
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_migrates_baseline_db(db):
+    _write_baseline_db(db)
+
+    conn = memory._ensure_db()
+    assert conn.execute("PRAGMA user_version;").fetchone()[0] == memory._SCHEMA_VERSION
+
+    row = conn.execute("SELECT stderr_hash, new_file_hash FROM fixes;").fetchone()
+    assert row["stderr_hash"] == memory._sha256(memory._needle(STDERR))
+    assert row["new_file_hash"] == bytes.fromhex(_hex("new"))
+
+    # migrated rows are found by both the FTS path and the hash fallback
+    assert [h.id for h in memory.search_similar("x\n" + STDERR.splitlines()[-1])] == [1]
+    rows = conn.execute(memory._FALLBACK_SQL, (memory._sha256(memory._needle(STDERR)), 3)).fetchall()
+    assert [r["id"] for r in rows] == [1]
+
+
+def test_save_and_search_roundtrip(db):
+    memory.save_fixes(
+        [
+            memory.fix_record("python bug.py", "bug.py", STDERR, "-a\n+b", "b"),
+            memory.fix_record("python bug.py", "bug.py", "Traceback\nNameError: name 'foo' is not defined", "-a\n+b", "b"),
+        ]
+    )
+
+    hits = memory.search_similar("NameError: name 'foo' is not defined")
+    assert [h.id for h in hits] == [2]
+
+
+def test_fix_record_skips_empty():
+    assert memory.fix_record("cmd", "x.py", "", "-a\n+b", "b") is None
+    assert memory.fix_record("cmd", "x.py", "err", "  ", "b") is None
+
+
+def _open_and_search(path: str) -> int:
+    # runs in a fresh process: point memory at `path` and trigger the migration
+    from pathlib import Path
+
+    memory.DB_DIR = Path(path).parent
+    memory.DB_PATH = Path(path)
+    return len(memory.search_similar(STDERR))
+
+
+def test_concurrent_migration_of_baseline_db(db):
+    import multiprocessing
+
+    for trial in range(5):
+        path = db.parent / f"concurrent{trial}.db"
+        _write_baseline_db(path)
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(3) as pool:
+            assert pool.map(_open_and_search, [str(path)] * 3) == [1, 1, 1]
@@ -0,0 +1,23 @@
+import io
+
+from fixloop.runner import _drain, run_command
+
+
+def test_drain_keeps_everything_up_to_limit():
+    for size in (0, 5, 9, 10):
+        data = bytes(range(size))
+        assert _drain(io.BytesIO(data), 10) == (data, False)
+
+
+def test_drain_keeps_head_and_tail_past_limit():
+    data = b"abcdefghijk"  # limit + 1
+    assert _drain(io.BytesIO(data), 10) == (b"abcde\n...\nghijk", True)
+
+    data = b"x" * 5 + b"-" * 200000 + b"y" * 5
+    assert _drain(io.BytesIO(data), 10) == (b"xxxxx\n...\nyyyyy", True)
+
+
+def test_run_command_captures_both_streams():
+    r = run_command("python -c \"import sys; print('out'); sys.stderr.write('err'); sys.exit(3)\"")
+    assert (r.returncode, r.stdout, r.stderr) == (3, "out\n", "err")
+    assert not r.stdout_truncated and not r.stderr_truncated